@@ -4,7 +4,8 @@ import climax
 @climax.command()
 @climax.argument('--username', '-u', required=True, help='your username')
 @climax.argument('--password', '-p', action=climax.PasswordPrompt,
-                 required=True, help='prompt for your password')
+                 env='LOGIN_PASSWORD', agent=True, required=True,
+                 help='prompt for your password')
 def login(username, password):
     """Login example."""
     print(username, password)
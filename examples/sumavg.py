@@ -2,13 +2,13 @@
 import climax
 
 
-@climax.group()
+@climax.group(response_files=True)
 def main():
     pass
 
 
 @main.command()
-@climax.argument('values', type=int, nargs='+',
+@climax.argument('values', action=climax.Array, typecode='q',
                  help='sequence of numbers to add')
 def add(values):
     """add numbers"""
@@ -16,7 +16,7 @@ def add(values):
 
 
 @main.command()
-@climax.argument('values', type=int, nargs='+',
+@climax.argument('values', action=climax.Array, typecode='q',
                  help='sequence of numbers to average')
 def avg(values):
     """average numbers"""
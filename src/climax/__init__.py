@@ -1,8 +1,41 @@
 import argparse
+import array
+import atexit
+from contextlib import contextmanager
+import copy
 from functools import wraps
 from functools import partial
 import getpass
 from gettext import gettext as _
+import json
+import math
+import os
+import re
+import shlex
+import signal
+import sys
+import threading
+import time
+import warnings
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+
+_shell_chars = re.compile(r'[\'"\\]')
+_quote_chars = {None: _shell_chars, "'": re.compile("'"),
+                '"': re.compile(r'["\\]')}
+_metrics = None
+_metrics_writer = None
+_registry_lock = threading.RLock()
+_password_state = threading.local()
+_limit_names = ('timeout', 'max_rss', 'cpu_seconds')
 
 
 class _CopiedArgumentParser(argparse.ArgumentParser):
@@ -17,13 +50,838 @@ class _CopiedArgumentParser(argparse.ArgumentParser):
             setattr(self, k, v)
 
 
+class _PluginArgumentParser(argparse.ArgumentParser):
+    """ArgumentParser subclass for a command or group that is provided by a
+    plugin. The plugin is imported the first time the parser is used, and
+    then everything is copied from its parser.
+    """
+    def __init__(self, *args, **kwargs):
+        self._plugin = kwargs.pop('plugin')
+        super(_PluginArgumentParser, self).__init__(*args, **kwargs)
+
+    def parse_known_args(self, args=None, namespace=None):
+        if self._plugin is not None:
+            with _registry_lock:
+                if self._plugin is not None:
+                    self._load_plugin(*self._plugin)
+        return super(_PluginArgumentParser, self).parse_known_args(
+            args, namespace)
+
+    def _load_plugin(self, group, name, value):
+        from importlib.metadata import EntryPoint
+
+        try:
+            f = EntryPoint(name, value, None).load().func
+        except Exception as exc:
+            self.error('plugin {} could not be loaded: {!r}'.format(name, exc))
+        prog = self.prog
+        for k, v in vars(f.parser).items():
+            setattr(self, k, v)
+        self.prog = prog
+        self._defaults = dict(self._defaults)
+        self.set_defaults(**{'_func_' + group.__name__: f})
+        f._name = name
+        self._plugin = None
+
+
 class PasswordPrompt(argparse.Action):
+    """Argparse action that prompts for a password without echoing it.
+
+    For unattended use the password can also be obtained from a file
+    descriptor given in ``fd``, an environment variable given in ``env``, or
+    a file given in ``file``. Passing ``agent=True``, or the path of a Unix
+    socket, keeps passwords in a credential agent process for ``agent_ttl``
+    seconds, so that repeated invocations do not need to prompt again. The
+    sources are tried in the order given in ``sources``.
+
+    Passwords are stored in the agent under a key made from the path of the
+    script and the values of the other arguments, or from the value returned
+    by ``agent_key``, a function that receives the parsed arguments. For the
+    other arguments to be known, the password is obtained after the whole
+    command line is parsed, so the agent is only used in climax commands.
+    """
     def __init__(self, *args, **kwargs):
+        self.fd = kwargs.pop('fd', None)
+        self.env = kwargs.pop('env', None)
+        self.file = kwargs.pop('file', None)
+        self.agent = kwargs.pop('agent', None)
+        if not hasattr(os, 'fork'):  # pragma: no cover
+            self.agent = None  # the agent is not supported on this platform
+        self.agent_ttl = kwargs.pop('agent_ttl', 300)
+        self.agent_key = kwargs.pop('agent_key', None)
+        self.sources = kwargs.pop('sources', ('fd', 'env', 'file', 'agent',
+                                              'prompt'))
         kwargs['nargs'] = 0
         super(PasswordPrompt, self).__init__(*args, **kwargs)
 
     def __call__(self, parser, namespace, values, option_string):
-        setattr(namespace, self.dest, getpass.getpass())
+        pending = getattr(_password_state, 'pending', None)
+        if pending is None:
+            # not parsed by a climax command, so the other arguments are not
+            # known and the agent cannot be used safely
+            self._resolve(parser, namespace, None)
+        else:
+            setattr(namespace, self.dest, None)
+            pending.append((self, parser))
+
+    def _resolve(self, parser, namespace, exclude):
+        """Obtain the password and store it in the namespace. The arguments
+        named in ``exclude`` are left out of the agent key. If ``exclude`` is
+        ``None`` the agent is not used.
+        """
+        password = None
+        agent = None
+        for source in self.sources:
+            if source == 'agent':
+                if exclude is not None:
+                    agent = self._agent_socket()
+                if agent is not None:
+                    key = self._agent_key(parser, namespace, exclude)
+                    password = (_agent_request(agent, {'key': key}) or
+                                {}).get('password')
+                    if password is not None:
+                        agent = None  # nothing to store
+                        break
+                continue
+            try:
+                password = self._get_password(source)
+            except OSError as exc:
+                parser.error(str(exc))
+            if password is not None:
+                break
+        if password is not None and agent is not None:
+            try:
+                _store_agent_password(agent, self.agent_ttl, key, password)
+            except OSError:  # pragma: no cover
+                pass  # the agent is an optimization, so errors are ignored
+        setattr(namespace, self.dest, password)
+
+    def _agent_key(self, parser, namespace, exclude):
+        """Return the key of the password in the agent."""
+        import hashlib
+
+        if self.agent_key is not None:
+            values = self.agent_key(namespace)
+        else:
+            values = {k: v for k, v in vars(namespace).items()
+                      if k not in exclude}
+        if isinstance(values, dict):
+            # the functions that handle sub-commands are given by name
+            values = {k: '{}.{}'.format(v.__module__, v.__qualname__)
+                      if callable(v) else v for k, v in values.items()}
+        digest = hashlib.sha256()
+        _hash_value(digest, [os.path.realpath(sys.argv[0]), parser.prog,
+                             self.dest])
+        try:
+            _hash_value(digest, values)
+        except TypeError:
+            digest.update(repr(values).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _agent_socket(self):
+        """Return the path of the agent socket, or ``None`` if the agent is
+        not available.
+        """
+        if self.agent is not True:
+            return self.agent
+        try:
+            return _agent_path()
+        except OSError:
+            return None
+
+    def _get_password(self, source):
+        if source == 'fd' and self.fd is not None:
+            # read one byte at a time to leave the following lines unread
+            line = b''
+            while not line.endswith(b'\n'):
+                c = os.read(self.fd, 1)
+                if not c:
+                    break
+                line += c
+            return line.decode('utf-8').rstrip('\n') if line else None
+        elif source == 'env' and self.env is not None:
+            return os.environ.get(self.env)
+        elif source == 'file' and self.file is not None:
+            with open(self.file) as fp:
+                return fp.readline().rstrip('\n')
+        elif source == 'prompt':
+            return getpass.getpass()
+
+
+def _agent_path():
+    """Return the default path of the credential agent socket, or ``None``
+    if a private directory for it is not available.
+    """
+    import tempfile
+
+    directory = os.environ.get('XDG_RUNTIME_DIR')
+    if not directory:
+        directory = os.path.join(tempfile.gettempdir(),
+                                 'climax-{}'.format(os.getuid()))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.stat(directory)
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        return None
+    return os.path.join(directory, 'climax-agent.sock')
+
+
+def _agent_request(path, request):
+    """Send a request to the credential agent listening on the given socket.
+
+    Return the reply, or ``None`` if the agent is not running, or if the
+    socket is not owned by the current user.
+    """
+    import socket
+
+    try:
+        if os.stat(path).st_uid != os.getuid():
+            return None
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(5)
+            sock.connect(path)
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as fp:
+                return json.loads(fp.readline().decode('utf-8'))
+    except (OSError, ValueError):
+        return None
+
+
+def _store_agent_password(path, ttl, key, password):
+    """Store a password in the credential agent, starting it if needed."""
+    import socket
+    import subprocess
+
+    request = {'key': key, 'password': password, 'ttl': ttl}
+    if _agent_request(path, request) is not None:
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(path)
+        os.chmod(path, 0o600)
+        server.listen()
+        # the agent runs in a new Python process, as forking this process is
+        # not safe when it has multiple threads
+        env = dict(os.environ)
+        env.pop('CLIMAX_METRICS', None)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+            ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+        agent = subprocess.Popen(
+            [sys.executable, '-c',
+             'import climax; climax._agent_main({}, {!r})'.format(
+                 server.fileno(), path)],
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, env=env, close_fds=True,
+            pass_fds=(server.fileno(),), start_new_session=True)
+        agent.communicate(json.dumps(request).encode('utf-8') + b'\n')
+
+
+def _agent_main(fd, path):  # pragma: no cover
+    """Start the credential agent.
+
+    This function runs in a new process, which receives the listening socket
+    and the first password. The agent is forked into the background, so
+    that the process that started it does not need to wait for it.
+    """
+    import socket
+
+    server = socket.socket(fileno=fd)
+    request = json.loads(sys.stdin.readline())
+    sys.stdin.close()
+    try:
+        if os.fork() == 0:
+            _run_agent(server, path, {request['key']: (
+                time.time() + request['ttl'], request['password'])})
+    finally:
+        os._exit(0)
+
+
+def _run_agent(server, path, passwords):
+    """Serve passwords from a credential agent until they all expire."""
+    import socket
+
+    inode = os.stat(path).st_ino
+    while passwords:
+        server.settimeout(max(
+            min(value[0] for value in passwords.values()) - time.time(),
+            0.001))
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            conn = None
+        if conn is not None:
+            with conn:
+                try:
+                    conn.settimeout(5)
+                    with conn.makefile('rb') as fp:
+                        request = json.loads(fp.readline().decode('utf-8'))
+                    reply = {}
+                    if 'password' in request:
+                        passwords[request['key']] = (
+                            time.time() + request['ttl'],
+                            request['password'])
+                    elif request['key'] in passwords:
+                        reply['password'] = passwords[request['key']][1]
+                    conn.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+                except (OSError, ValueError, KeyError, TypeError):
+                    pass
+        now = time.time()
+        passwords = {key: value for key, value in passwords.items()
+                     if value[0] > now}
+    server.close()
+    try:
+        # only remove the socket if it was not replaced by another agent
+        if os.stat(path).st_ino == inode:
+            os.remove(path)
+    except OSError:  # pragma: no cover
+        pass
+
+
+class Array(argparse.Action):
+    """Argparse action that stores a list of numbers as a compact array.
+
+    All the values given to the argument are converted in bulk into an
+    ``array.array`` object with the requested ``typecode`` (``'d'`` by
+    default). When NumPy is installed the array is returned as a NumPy array
+    that shares the same memory, unless ``numpy=False`` is given.
+    """
+    def __init__(self, *args, **kwargs):
+        self.typecode = kwargs.pop('typecode', 'd')
+        self.numpy = kwargs.pop('numpy', True)
+        if self.typecode not in array.typecodes or self.typecode in 'uw':
+            raise ValueError('invalid array typecode %r' % self.typecode)
+        kwargs.setdefault('nargs', '+')
+        super(Array, self).__init__(*args, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        if isinstance(values, str):
+            values = [values]
+        convert = float if self.typecode in 'fd' else int
+        try:
+            result = array.array(self.typecode, map(convert, values))
+        except (ValueError, OverflowError):
+            # find the offending value to report it in the error message
+            for i, value in enumerate(values):
+                try:
+                    array.array(self.typecode, [convert(value)])
+                except (ValueError, OverflowError):
+                    raise argparse.ArgumentError(
+                        self, _('invalid %r value at position %d: %r') % (
+                            self.typecode, i + 1, value))
+            raise  # pragma: no cover
+        if self.numpy:
+            try:
+                import numpy
+            except ImportError:
+                pass
+            else:
+                result = numpy.frombuffer(result, dtype=self.typecode)
+        setattr(namespace, self.dest, result)
+
+
+class CommandTimeout(BaseException):
+    """Exception raised inside a command that exceeds its time limit.
+
+    This exception does not inherit from ``Exception``, so that it is not
+    accidentally caught by the command.
+    """
+
+
+class Metrics(object):
+    """In-process metrics for command invocations.
+
+    Invocation counts, exit status counts and latency histograms for the
+    parse, group and command phases are collected in memory, and merged into
+    the metrics file each time :meth:`write` is called. The file is written
+    in the Prometheus text format, or in JSON if its name ends in ``.json``.
+    """
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+    def __init__(self, path):
+        self.path = path
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, status, durations):
+        """Record a command invocation."""
+        command = (('command', name),)
+        with self.lock:
+            self._add('climax_invocations_total', command, 1)
+            self._add('climax_exits_total',
+                      command + (('status', str(status)),), 1)
+            for phase, duration in durations.items():
+                labels = command + (('phase', phase),)
+                for le in self.buckets:
+                    if duration <= le:
+                        self._add('climax_duration_seconds_bucket',
+                                  labels + (('le', str(le)),), 1)
+                self._add('climax_duration_seconds_bucket',
+                          labels + (('le', '+Inf'),), 1)
+                self._add('climax_duration_seconds_sum', labels, duration)
+                self._add('climax_duration_seconds_count', labels, 1)
+
+    def write(self):
+        """Merge the collected metrics into the metrics file."""
+        with self.lock:
+            samples, self.samples = self.samples, {}
+        if not samples:
+            return
+        with _file_lock(self.path + '.lock'):
+            try:
+                with open(self.path) as fp:
+                    for key, value in self._load(fp).items():
+                        samples[key] = samples.get(key, 0) + value
+            except FileNotFoundError:
+                pass
+            tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp, 'w') as fp:
+                self._dump(samples, fp)
+            os.replace(tmp, self.path)
+
+    def _add(self, metric, labels, value):
+        key = (metric, tuple(sorted(labels)))
+        self.samples[key] = self.samples.get(key, 0) + value
+
+    def _load(self, fp):
+        if self.path.endswith('.json'):
+            return {(s['name'], tuple(sorted(s['labels'].items()))): s['value']
+                    for s in json.load(fp)}
+        samples = {}
+        for line in fp:
+            m = re.match(r'^(\w+)\{(.*)\} (\S+)$', line)
+            if m:
+                labels = tuple(sorted(re.findall(r'(\w+)="([^"]*)"',
+                                                 m.group(2))))
+                samples[(m.group(1), labels)] = float(m.group(3))
+        return samples
+
+    def _dump(self, samples, fp):
+        if self.path.endswith('.json'):
+            json.dump([{'name': name, 'labels': dict(labels), 'value': value}
+                       for (name, labels), value in sorted(samples.items())],
+                      fp, indent=2)
+            return
+        metrics = (
+            ('climax_invocations_total', 'counter',
+             'Number of command invocations.'),
+            ('climax_exits_total', 'counter',
+             'Number of command invocations by exit status.'),
+            ('climax_duration_seconds', 'histogram',
+             'Duration of each invocation phase in seconds.'),
+        )
+        for metric, type, help in metrics:
+            fp.write('# HELP {} {}\n# TYPE {} {}\n'.format(
+                metric, help, metric, type))
+            for (name, labels), value in sorted(samples.items()):
+                if name == metric or name.startswith(metric + '_'):
+                    if value == int(value):
+                        value = int(value)
+                    fp.write('{}{{{}}} {}\n'.format(name, ','.join(
+                        '{}="{}"'.format(k, v) for k, v in labels), value))
+
+
+class _Invocation(object):
+    """Context manager that measures a command invocation and records it in
+    the metrics, if they are enabled.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.durations = {}
+        self.phase = 'parse'
+        self.start = time.perf_counter()
+
+    def begin(self, phase):
+        """End the current phase, recording its duration, and start a new
+        one.
+        """
+        now = time.perf_counter()
+        elapsed = now - self.start
+        self.durations[self.phase] = \
+            self.durations.get(self.phase, 0) + elapsed
+        self.phase = phase
+        self.start = now
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if _metrics is None:
+            return
+        self.begin(None)
+        if exc_type is None:
+            status = 0
+        elif issubclass(exc_type, SystemExit):
+            code = exc_value.code
+            status = code if isinstance(code, int) else int(code is not None)
+        else:
+            status = 1
+        _metrics.record(self.name, status, self.durations)
+
+
+@contextmanager
+def _file_lock(path):
+    """Hold an exclusive lock on the given lock file, where supported."""
+    with open(path, 'a') as fp:
+        if fcntl is not None:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+        yield
+
+
+def enable_metrics(path, interval=None):
+    """Enable metrics collection for all climax commands.
+
+    The metrics are written to ``path`` when the process exits. For long
+    running processes, ``interval`` can be given to also write them
+    periodically, in seconds. Metrics can also be enabled by setting the
+    ``CLIMAX_METRICS`` environment variable to the path of the metrics file.
+    Calling this function again changes the path and the interval of the
+    metrics that are already enabled.
+    """
+    global _metrics, _metrics_writer
+    with _registry_lock:
+        if _metrics is None:
+            _metrics = Metrics(path)
+        else:
+            _metrics.path = path
+        if _metrics_writer is not None:
+            _metrics_writer.set()
+            _metrics_writer = None
+        if interval:
+            _metrics_writer = threading.Event()
+            threading.Thread(target=_write_metrics_periodically,
+                             args=(_metrics, interval, _metrics_writer),
+                             daemon=True).start()
+        return _metrics
+
+
+def disable_metrics():
+    """Disable metrics collection.
+
+    Any metrics that have not been written yet are written before returning.
+    """
+    global _metrics, _metrics_writer
+    with _registry_lock:
+        if _metrics_writer is not None:
+            _metrics_writer.set()
+            _metrics_writer = None
+        metrics = _metrics
+        _metrics = None
+    if metrics is not None:
+        metrics.write()
+
+
+def _write_metrics_periodically(metrics, interval, stopped):
+    while not stopped.wait(interval):
+        metrics.write()
+
+
+@atexit.register
+def _write_metrics():
+    if _metrics is not None:
+        _metrics.write()
+
+
+def _open_quote(line, quote=None):
+    """Return the quote character that is left open at the end of a line,
+    given the one that is open at its start.
+    """
+    pos = 0
+    while True:
+        m = _quote_chars[quote].search(line, pos)
+        if not m:
+            return quote
+        pos = m.end()
+        if m.group() == '\\':
+            pos += 1  # skip the escaped character
+        elif quote is None:
+            quote = m.group()
+        else:
+            quote = None
+
+
+def _read_response_file(path):
+    """Generator that returns the tokens stored in a response file.
+
+    The file is tokenized line by line using shell-like quoting rules, so
+    that it does not need to be loaded in memory all at once. Lines that
+    start with ``#`` are comments, but ``#`` has no special meaning anywhere
+    else. Lines without any quoting are split directly, as this is much
+    faster than using ``shlex``. Quoted strings that span multiple lines are
+    passed to ``shlex`` once they are closed. The path ``-`` reads the tokens
+    from the standard input.
+    """
+    if path == '-':
+        fp = sys.stdin
+    else:
+        fp = open(path)
+    try:
+        lines = []
+        quote = None
+        for line in fp:
+            if not lines and line.lstrip().startswith('#'):
+                continue
+            if not lines and not _shell_chars.search(line):
+                for token in line.split():
+                    yield token
+                continue
+            lines.append(line)
+            quote = _open_quote(line, quote)
+            if quote is None:
+                for token in shlex.split(''.join(lines), comments=False):
+                    yield token
+                lines = []
+        if lines:
+            raise ValueError(_('No closing quotation'))
+    finally:
+        if fp is not sys.stdin:
+            fp.close()
+
+
+def _expand_response_files(args, open_files=()):
+    """Generator that expands ``@file`` arguments into the tokens stored in
+    the given file. Response files can reference other response files.
+    """
+    for arg in args:
+        if len(arg) > 1 and arg[0] == '@':
+            path = arg[1:]
+            if path != '-':
+                path = os.path.realpath(path)
+                if path in open_files:
+                    raise ValueError(_('response file %s includes itself')
+                                     % arg[1:])
+            for token in _expand_response_files(_read_response_file(path),
+                                                open_files + (path,)):
+                yield token
+        else:
+            yield arg
+
+
+def _parse_args(f, args):
+    """Parse the command line for a command or group."""
+    if f.response_files:
+        if args is None:
+            args = sys.argv[1:]
+        try:
+            args = list(_expand_response_files(args))
+        except (OSError, ValueError) as exc:
+            f.parser.error(str(exc))
+
+    # passwords are obtained once all the other arguments are known
+    pending = []
+    previous = getattr(_password_state, 'pending', None)
+    _password_state.pending = pending
+    try:
+        namespace = f.parser.parse_args(args)
+    finally:
+        _password_state.pending = previous
+    exclude = {action.dest for action, parser in pending}
+    for action, parser in pending:
+        action._resolve(parser, namespace, exclude)
+    return namespace
+
+
+def _parse_size(size):
+    """Convert a memory size such as ``512M`` or ``2G`` to bytes."""
+    if isinstance(size, int):
+        return size
+    m = re.match(r'^(\d+(?:\.\d+)?)([KMGT]?)B?$', size.strip().upper())
+    if not m:
+        raise argparse.ArgumentTypeError(_('invalid size: %r') % size)
+    return int(float(m.group(1)) * 1024 ** ' KMGT'.index(m.group(2) or ' '))
+
+
+def _pop_limits(f, kwargs):
+    """Remove the resource limits from the arguments of a decorator."""
+    f._limits = {name: kwargs.pop(name) for name in _limit_names
+                 if name in kwargs}
+    f._limits = {k: v for k, v in f._limits.items() if v is not None}
+    if 'max_rss' in f._limits:
+        f._limits['max_rss'] = _parse_size(f._limits['max_rss'])
+
+
+def _add_limit_options(parser):
+    """Add options to set the resource limits from the command line."""
+    parser.add_argument('--timeout', type=float, dest='_limit_timeout',
+                        metavar='SECONDS',
+                        help='maximum time the command can run')
+    parser.add_argument('--max-rss', type=_parse_size, dest='_limit_max_rss',
+                        metavar='SIZE',
+                        help='maximum memory the command can use, such as '
+                        '512M or 2G')
+    parser.add_argument('--cpu-seconds', type=float,
+                        dest='_limit_cpu_seconds', metavar='SECONDS',
+                        help='maximum CPU time the command can use')
+
+
+def _get_limits(parsed_args, limits):
+    """Return the resource limits for a command, with the values given in
+    the command line overriding those given in the decorators.
+    """
+    limits = dict(limits)
+    for name in _limit_names:
+        value = parsed_args.pop('_limit_' + name, None)
+        if value is not None:
+            limits[name] = value
+    return limits
+
+
+def _timeout_handler(signum, frame):
+    raise CommandTimeout()
+
+
+@contextmanager
+def _limits(parser, timeout=None, max_rss=None, cpu_seconds=None):
+    """Context manager that enforces resource limits on a command.
+
+    The limits rely on signals and on process-wide resource limits, so they
+    are only enforced when the command runs in the main thread, and only on
+    platforms that support them. A command that exceeds its time limits exits
+    with status code 124.
+    """
+    if threading.current_thread() is not threading.main_thread() or \
+            not (timeout or max_rss or cpu_seconds):
+        yield
+        return
+    restore = []
+    try:
+        if timeout and hasattr(signal, 'SIGALRM'):
+            restore.append(_set_timer(timeout))
+        if cpu_seconds and resource is not None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            limit = int(math.ceil(usage.ru_utime + usage.ru_stime +
+                                  cpu_seconds))
+            restore.append(partial(signal.signal, signal.SIGXCPU,
+                                   signal.signal(signal.SIGXCPU,
+                                                 _timeout_handler)))
+            _set_limit(resource.RLIMIT_CPU, limit, restore)
+        if max_rss and resource is not None:
+            _set_limit(resource.RLIMIT_AS, max_rss, restore)
+        yield
+    except CommandTimeout:
+        parser.exit(124, _('%(prog)s: error: time limit exceeded\n') % {
+            'prog': parser.prog})
+    finally:
+        for func in reversed(restore):
+            func()
+
+
+def _set_timer(timeout):
+    """Start the timer for a command, and return a function that restores
+    the timer and signal handler that the application had before.
+    """
+    handler = signal.signal(signal.SIGALRM, _timeout_handler)
+    start = time.monotonic()
+    delay, interval = signal.setitimer(signal.ITIMER_REAL, timeout)
+
+    def restore():
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, handler)
+        if delay:
+            # resume the application's timer, minus the time that passed
+            signal.setitimer(signal.ITIMER_REAL, max(
+                delay - (time.monotonic() - start), 0.000001), interval)
+
+    return restore
+
+
+def _set_limit(name, value, restore):
+    """Lower the soft limit of a resource, and register how to restore it.
+
+    A limit that is already lower, for example one set by the operator, is
+    never raised.
+    """
+    soft, hard = resource.getrlimit(name)
+    if soft != resource.RLIM_INFINITY:
+        value = min(value, soft)
+    if hard != resource.RLIM_INFINITY:
+        value = min(value, hard)
+    resource.setrlimit(name, (value, hard))
+    restore.append(partial(resource.setrlimit, name, (soft, hard)))
+
+
+def _distributions_fingerprint():
+    """Return a hash of the installed distributions.
+
+    The names of the metadata directories of the distributions include their
+    versions, so listing them is much faster than reading their metadata.
+    """
+    import hashlib
+
+    names = []
+    for path in sys.path:
+        try:
+            entries = os.scandir(path or '.')
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.endswith(('.dist-info', '.egg-info')):
+                    try:
+                        mtime = entry.stat().st_mtime
+                    except OSError:  # pragma: no cover
+                        continue
+                    names.append('{} {}'.format(entry.path, mtime))
+    return hashlib.sha256('\n'.join(sorted(names)).encode(
+        'utf-8')).hexdigest()
+
+
+def _plugin_index(entry_point_group):
+    """Return the name, entry point and help of the plugins registered in
+    the given entry point group.
+
+    Finding the plugins requires importing them, so the results are cached,
+    and only discovered again when the installed distributions change.
+    """
+    from importlib.metadata import entry_points
+
+    fingerprint = _distributions_fingerprint()
+    path = os.path.join(_cache_dir(), 'plugins',
+                        re.sub(r'[^\w.-]', '_', entry_point_group) + '.json')
+    try:
+        with open(path) as fp:
+            index = json.load(fp)
+        if index['fingerprint'] == fingerprint:
+            return index['plugins']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        eps = eps.select(group=entry_point_group)
+    else:  # pragma: no cover
+        eps = eps.get(entry_point_group, [])
+    plugins = []
+    complete = True
+    for ep in eps:
+        try:
+            doc = ep.load().func.__doc__
+        except Exception as exc:
+            # a broken plugin must not break the commands that do work
+            warnings.warn('plugin {} could not be loaded: {!r}'.format(
+                ep.name, exc))
+            complete = False
+            continue
+        plugins.append({'name': ep.name, 'value': ep.value, 'help': doc})
+    plugins.sort(key=lambda plugin: plugin['name'])
+    if complete:
+        # the index is not cached while plugins are failing, so that they
+        # are tried again on the next invocation
+        _write_file(path, json.dumps({'fingerprint': fingerprint,
+                                      'plugins': plugins}).encode('utf-8'))
+    return plugins
+
+
+def _add_plugins(group, entry_point_group):
+    """Add the commands and groups provided by plugins to a group."""
+    for plugin in _plugin_index(entry_point_group):
+        with _adding_parser(group._subparsers) as subparsers:
+            subparsers._parser_class = _PluginArgumentParser
+            subparsers.add_parser(plugin['name'], help=plugin['help'],
+                                  plugin=(group, plugin['name'],
+                                          plugin['value']))
 
 
 def command(*args, **kwargs):
@@ -32,9 +890,15 @@ def command(*args, **kwargs):
     The arguments to this decorator are those of the
     `ArgumentParser <https://docs.python.org/3/library/argparse.html\
 #argumentparser-objects>`_
-    object constructor.
+    object constructor. Pass ``response_files=True`` to expand ``@file``
+    arguments into the contents of the given file. The ``timeout``,
+    ``max_rss`` and ``cpu_seconds`` arguments set limits for the command, and
+    ``limit_options=True`` adds options to set them from the command line.
     """
     def decorator(f):
+        f.response_files = kwargs.pop('response_files', False)
+        limit_options = kwargs.pop('limit_options', False)
+        _pop_limits(f, kwargs)
         if 'description' not in kwargs:
             kwargs['description'] = f.__doc__
 
@@ -53,11 +917,16 @@ def command(*args, **kwargs):
 
         for arg in getattr(f, '_arguments', []):
             f.parser.add_argument(*arg[0], **arg[1])
+        if limit_options:
+            _add_limit_options(f.parser)
 
         @wraps(f)
         def wrapper(args=None):
-            kwargs = f.parser.parse_args(args)
-            return f(**vars(kwargs))
+            with _Invocation(f.__name__) as invocation:
+                kwargs = vars(_parse_args(f, args))
+                invocation.begin('command')
+                with _limits(f.parser, **_get_limits(kwargs, f._limits)):
+                    return f(**kwargs)
 
         wrapper.func = f
         return wrapper
@@ -74,6 +943,25 @@ def parent(*args, **kwargs):
     return command(*args, **kwargs)
 
 
+@contextmanager
+def _adding_parser(subparsers):
+    """Context manager to add parsers to a subparsers action.
+
+    The parsers are added to a copy of the action, and are made visible once
+    fully configured, so that it is safe to add commands to a group while
+    other threads are invoking it.
+    """
+    with _registry_lock:
+        copy_ = copy.copy(subparsers)
+        copy_._name_parser_map = copy_.choices = dict(
+            subparsers._name_parser_map)
+        copy_._choices_actions = list(subparsers._choices_actions)
+        yield copy_
+        subparsers._choices_actions = copy_._choices_actions
+        subparsers._name_parser_map = copy_._name_parser_map
+        subparsers.choices = copy_.choices
+
+
 def _subcommand(group, *args, **kwargs):
     """Decorator to define a subcommand.
 
@@ -82,25 +970,23 @@ def _subcommand(group, *args, **kwargs):
     def decorator(f):
         if 'help' not in kwargs:
             kwargs['help'] = f.__doc__
-        _parser_class = group._subparsers._parser_class
-        if 'parser' in kwargs:
-            # use a copy of the given parser
-            group._subparsers._parser_class = _CopiedArgumentParser
+        _pop_limits(f, kwargs)
         if 'parents' in kwargs:
             if not hasattr(f, '_argnames'):  # pragma: no cover
                 f._argnames = []
             for p in kwargs['parents']:
                 f._argnames += p._argnames if hasattr(p, '_argnames') else []
             kwargs['parents'] = [p.parser for p in kwargs['parents']]
-        if args == ():
-            f.parser = group._subparsers.add_parser(f.__name__, **kwargs)
-        else:
-            f.parser = group._subparsers.add_parser(*args, **kwargs)
-        f.parser.set_defaults(**{'_func_' + group.__name__: f})
-        f.climax = 'parser' not in kwargs
-        group._subparsers._parser_class = _parser_class
-        for arg in getattr(f, '_arguments', []):
-            f.parser.add_argument(*arg[0], **arg[1])
+        f._name = args[0] if args else f.__name__
+        with _adding_parser(group._subparsers) as subparsers:
+            if 'parser' in kwargs:
+                # use a copy of the given parser
+                subparsers._parser_class = _CopiedArgumentParser
+            f.parser = subparsers.add_parser(f._name, *args[1:], **kwargs)
+            f.parser.set_defaults(**{'_func_' + group.__name__: f})
+            f.climax = 'parser' not in kwargs
+            for arg in getattr(f, '_arguments', []):
+                f.parser.add_argument(*arg[0], **arg[1])
         return f
     return decorator
 
@@ -112,6 +998,8 @@ def _subgroup(group, *args, **kwargs):
     """
     def decorator(f):
         f.required = kwargs.pop('required', True)
+        plugins = kwargs.pop('plugins', None)
+        _pop_limits(f, kwargs)
         if 'parents' in kwargs:
             if not hasattr(f, '_argnames'):  # pragma: no cover
                 f._argnames = []
@@ -120,17 +1008,18 @@ def _subgroup(group, *args, **kwargs):
             kwargs['parents'] = [p.parser for p in kwargs['parents']]
         if 'help' not in kwargs:
             kwargs['help'] = f.__doc__
-        if args == ():
-            f.parser = group._subparsers.add_parser(f.__name__, **kwargs)
-        else:
-            f.parser = group._subparsers.add_parser(*args, **kwargs)
-        f.parser.set_defaults(**{'_func_' + group.__name__: f})
-        f.climax = True
-        for arg in getattr(f, '_arguments', []):
-            f.parser.add_argument(*arg[0], **arg[1])
-        f._subparsers = f.parser.add_subparsers()
+        f._name = args[0] if args else f.__name__
+        with _adding_parser(group._subparsers) as subparsers:
+            f.parser = subparsers.add_parser(f._name, *args[1:], **kwargs)
+            f.parser.set_defaults(**{'_func_' + group.__name__: f})
+            f.climax = True
+            for arg in getattr(f, '_arguments', []):
+                f.parser.add_argument(*arg[0], **arg[1])
+            f._subparsers = f.parser.add_subparsers()
         f.command = partial(_subcommand, f)
         f.group = partial(_subgroup, f)
+        if plugins:
+            _add_plugins(f, plugins)
         return f
     return decorator
 
@@ -141,10 +1030,19 @@ def group(*args, **kwargs):
     The arguments to this decorator are those of the
     `ArgumentParser <https://docs.python.org/3/library/argparse.html\
 #argumentparser-objects>`_
-    object constructor.
+    object constructor. Pass ``response_files=True`` to expand ``@file``
+    arguments into the contents of the given file. The ``timeout``,
+    ``max_rss`` and ``cpu_seconds`` arguments set limits for all the commands
+    in the group, and ``limit_options=True`` adds options to set them from
+    the command line. The ``plugins`` argument gives the name of an entry
+    point group with plugins that provide additional commands and groups.
     """
     def decorator(f):
         f.required = kwargs.pop('required', True)
+        f.response_files = kwargs.pop('response_files', False)
+        limit_options = kwargs.pop('limit_options', False)
+        plugins = kwargs.pop('plugins', None)
+        _pop_limits(f, kwargs)
         if 'parents' in kwargs:
             if not hasattr(f, '_argnames'):  # pragma: no cover
                 f._argnames = []
@@ -155,49 +1053,68 @@ def group(*args, **kwargs):
         f.climax = True
         for arg in getattr(f, '_arguments', []):
             f.parser.add_argument(*arg[0], **arg[1])
+        if limit_options:
+            _add_limit_options(f.parser)
         f._subparsers = f.parser.add_subparsers()
         f.command = partial(_subcommand, f)
         f.group = partial(_subgroup, f)
+        if plugins:
+            _add_plugins(f, plugins)
 
         @wraps(f)
         def wrapper(args=None):
-            parsed_args = vars(f.parser.parse_args(args))
-
-            # in Python 3.3+, sub-commands are optional by default
-            # so required parsers need to be validated by hand here
-            func = f
-            while '_func_' + func.__name__ in parsed_args:
-                func = parsed_args.get('_func_' + func.__name__)
-            if getattr(func, 'required', False):
-                f.parser.error('too few arguments')
-
-            # call the group function
-            filtered_args = {arg: parsed_args[arg]
-                             for arg in parsed_args.keys()
-                             if arg in getattr(f, '_argnames', [])}
-            parsed_args = {arg: parsed_args[arg] for arg in parsed_args.keys()
-                           if arg not in filtered_args}
-            ctx = f(**filtered_args)
-
-            # call the sub-command function (or chain)
-            func = f
-            while '_func_' + func.__name__ in parsed_args:
-                func = parsed_args.pop('_func_' + func.__name__)
-                if getattr(func, 'climax', False):
+            with _Invocation(f.__name__) as invocation:
+                parsed_args = vars(_parse_args(f, args))
+
+                # in Python 3.3+, sub-commands are optional by default
+                # so required parsers need to be validated by hand here
+                func = f
+                limits = f._limits
+                while '_func_' + func.__name__ in parsed_args:
+                    func = parsed_args.get('_func_' + func.__name__)
+                    invocation.name += '.' + func._name
+                    limits = dict(limits, **func._limits)
+                if getattr(func, 'required', False):
+                    f.parser.error('too few arguments')
+                limits = _get_limits(parsed_args, limits)
+                invocation.begin('group')
+                with _limits(f.parser, **limits):
+
+                    # call the group function
                     filtered_args = {arg: parsed_args[arg]
                                      for arg in parsed_args.keys()
-                                     if arg in getattr(func, '_argnames', [])}
+                                     if arg in getattr(f, '_argnames', [])}
                     parsed_args = {arg: parsed_args[arg]
                                    for arg in parsed_args.keys()
                                    if arg not in filtered_args}
-                else:
-                    # we don't have our metadata for this subparser, so we
-                    # send all remaining args to it
-                    filtered_args = parsed_args
-                    parsed_args = {}
-                filtered_args.update(ctx or {})
-                ctx = func(**filtered_args)
-            return ctx
+                    ctx = f(**filtered_args)
+
+                    # call the sub-command function (or chain)
+                    func = f
+                    while '_func_' + func.__name__ in parsed_args:
+                        func = parsed_args.pop('_func_' + func.__name__)
+                        if getattr(func, 'climax', False):
+                            filtered_args = {
+                                arg: parsed_args[arg]
+                                for arg in parsed_args.keys()
+                                if arg in getattr(func, '_argnames', [])}
+                            parsed_args = {
+                                arg: parsed_args[arg]
+                                for arg in parsed_args.keys()
+                                if arg not in filtered_args}
+                        else:
+                            # we don't have our metadata for this subparser,
+                            # so we send all remaining args to it
+                            filtered_args = parsed_args
+                            parsed_args = {}
+                        filtered_args.update(ctx or {})
+                        invocation.begin(
+                            'group' if hasattr(func, '_subparsers')
+                            else 'command')
+                        ctx = func(**filtered_args)
+                    return ctx
+
+        wrapper.func = f
         return wrapper
     return decorator
 
@@ -265,3 +1182,220 @@ def option(*args, **kwargs):
     Functionally equivalent to the ``argument`` decorator.
     """
     return argument(*args, **kwargs)
+
+
+class _CapturingStream(object):
+    """Proxy for ``sys.stdout`` that keeps a copy of what is written by the
+    threads that are capturing their output.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, s):
+        for captured in getattr(self.local, 'captures', []):
+            captured.append(s)
+        return self.stream.write(s)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+@contextmanager
+def _capture_stdout():
+    """Context manager that captures the output written to ``sys.stdout`` by
+    the current thread, while still writing it to the original stream.
+    """
+    with _registry_lock:
+        if not isinstance(sys.stdout, _CapturingStream):
+            sys.stdout = _CapturingStream(sys.stdout)
+        stream = sys.stdout
+    captured = []
+    stream.local.captures = getattr(stream.local, 'captures', []) + [
+        captured]
+    try:
+        yield captured
+    finally:
+        stream.local.captures = [c for c in stream.local.captures
+                                 if c is not captured]
+
+
+def _hash_value(digest, value):
+    """Add a value to a cache key.
+
+    Buffers such as bytes, ``array.array`` and NumPy arrays are added by
+    their contents. A ``TypeError`` is raised for values that do not have a
+    stable representation.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        digest.update(repr((type(value).__name__, value)).encode('utf-8'))
+    elif isinstance(value, (list, tuple)):
+        digest.update('{}:{}['.format(type(value).__name__,
+                                      len(value)).encode('utf-8'))
+        for item in value:
+            _hash_value(digest, item)
+    elif isinstance(value, dict):
+        digest.update('dict:{}{{'.format(len(value)).encode('utf-8'))
+        for k in sorted(value, key=repr):
+            _hash_value(digest, k)
+            _hash_value(digest, value[k])
+    else:
+        try:
+            view = memoryview(value)
+        except TypeError:
+            raise TypeError('cannot use {} in a cache key'.format(
+                type(value).__name__))
+        digest.update('buffer:{}:{}:{}:'.format(
+            view.format, view.shape, view.nbytes).encode('utf-8'))
+        digest.update(view.tobytes())
+
+
+def _write_file(path, data):
+    """Write a file atomically, returning ``True`` on success.
+
+    Errors are ignored, as the files written this way are caches.
+    """
+    import tempfile
+
+    tmp = None
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp, path)
+        return True
+    except OSError:
+        if tmp is not None:
+            try:
+                os.remove(tmp)
+            except OSError:  # pragma: no cover
+                pass
+        return False
+
+
+def _cache_dir():
+    """Return the directory where climax stores its caches."""
+    return os.environ.get('CLIMAX_CACHE_DIR') or os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or
+        os.path.join(os.path.expanduser('~'), '.cache'), 'climax')
+
+
+def _is_private_dir(path):
+    """Check that a directory is owned by the current user and that nobody
+    else can write to it, so that the files in it can be trusted.
+    """
+    if not hasattr(os, 'getuid'):  # pragma: no cover
+        return True
+    st = os.stat(path)
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+def _prune_cache(path, ttl, max_size):
+    """Remove expired entries from the cache directory of a command, and
+    then the oldest entries until it fits in the maximum size.
+    """
+    entries = []
+    for entry in os.scandir(path):
+        if entry.name.startswith('.'):
+            continue  # temporary file being written
+        try:
+            stat = entry.stat()
+        except OSError:  # pragma: no cover
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort()
+    now = time.time()
+    size = sum(entry[1] for entry in entries)
+    for mtime, entry_size, entry_path in entries:
+        if size <= max_size and (ttl is None or now - mtime <= ttl):
+            break
+        try:
+            os.remove(entry_path)
+        except OSError:  # pragma: no cover
+            continue
+        size -= entry_size
+
+
+def cached(ttl=None, key=None, version=None, max_size=64 * 1024 * 1024,
+           cache_dir=None):
+    """Decorator to cache the results of a command on disk.
+
+    This decorator must be given between the command decorator and the
+    function. The return value and the standard output of the command are
+    stored in the cache, and are reused when the command is invoked again
+    with the same arguments within ``ttl`` seconds. The ``key`` argument
+    is a list with the names of the arguments used in the cache key, which
+    by default are all the arguments given to the command. Changing
+    ``version`` invalidates all the previous entries. Each command has its
+    own cache directory, and old entries are removed when the directory of
+    the command exceeds ``max_size`` bytes, so the limit is per command.
+
+    The cache is stored in ``cache_dir``, or if not given, in the
+    ``CLIMAX_CACHE_DIR`` environment variable, or in a ``climax``
+    subdirectory of the user's cache directory. Results are only loaded from
+    a cache directory that is owned by the current user and not writable by
+    others, as loading them can run arbitrary code. A ``--no-cache`` option
+    is added to the command to bypass the cache.
+    """
+    def decorator(f):
+        name = '{}.{}'.format(f.__module__, f.__qualname__)
+        path = os.path.join(cache_dir or _cache_dir(),
+                            re.sub(r'[^\w.-]', '_', name))
+
+        @wraps(f)
+        def wrapper(**kwargs):
+            import hashlib
+            import pickle
+
+            no_cache = kwargs.pop('no_cache', False)
+            key_args = {arg: kwargs.get(arg) for arg in key or kwargs.keys()}
+            digest = hashlib.sha256()
+            try:
+                _hash_value(digest, [name, version, key_args])
+            except TypeError as exc:
+                warnings.warn('{} is not cached: {}'.format(name, exc))
+                return f(**kwargs)
+            filename = os.path.join(path, digest.hexdigest())
+            if not no_cache:
+                try:
+                    entry = None
+                    if _is_private_dir(path):
+                        with open(filename, 'rb') as fp:
+                            entry = pickle.load(fp)
+                        age = time.time() - entry['time']
+                        if ttl is not None and age > ttl:
+                            entry = None
+                except Exception:
+                    # stale entries can fail to load in many ways, for
+                    # example when a class in the result has been renamed
+                    entry = None
+                if entry is not None:
+                    sys.stdout.write(entry['stdout'])
+                    return entry['result']
+
+            with _capture_stdout() as captured:
+                result = f(**kwargs)
+            entry = {'time': time.time(), 'result': result,
+                     'stdout': ''.join(captured)}
+            try:
+                data = pickle.dumps(entry)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                return result  # the result cannot be cached
+            if _write_file(filename, data):
+                try:
+                    _prune_cache(path, ttl, max_size)
+                except OSError:  # pragma: no cover
+                    pass
+            return result
+
+        wrapper._arguments = list(getattr(f, '_arguments', [])) + [
+            (('--no-cache',), {'action': 'store_true',
+                               'help': 'ignore cached results'})]
+        wrapper._argnames = list(getattr(f, '_argnames', [])) + ['no_cache']
+        return wrapper
+    return decorator
+
+
+if os.environ.get('CLIMAX_METRICS'):  # pragma: no cover
+    enable_metrics(os.environ['CLIMAX_METRICS'])
@@ -1,6 +1,17 @@
 from __future__ import print_function
 
 import argparse
+import array
+import asyncio
+import concurrent.futures
+import json
+import os
+try:
+    import resource
+except ImportError:
+    resource = None
+import shutil
+import signal
 try:
     from StringIO import StringIO
 except ImportError:
@@ -11,6 +22,10 @@ try:
 except ImportError:
     import mock
 import sys
+import tempfile
+import threading
+import time
+import types
 
 import coverage
 
@@ -396,6 +411,867 @@ class TestClips(unittest.TestCase):
         self.assertEqual(self.stdout.getvalue(), 'secret\n')
         self.assertEqual(self.stderr.getvalue(), '')
 
+    @mock.patch.dict('sys.modules', {'numpy': None})
+    def test_array(self):
+        @climax.command()
+        @climax.argument('values', action=climax.Array, typecode='l')
+        @climax.argument('--weights', action=climax.Array, nargs='*')
+        def cmd(values, weights):
+            return values, weights
+
+        values, weights = cmd(['1', '2', '3', '--weights', '0.5', '1.5'])
+        self.assertEqual(values, array.array('l', [1, 2, 3]))
+        self.assertEqual(weights, array.array('d', [0.5, 1.5]))
+
+        self.assertRaises(SystemExit, cmd, ['1', '2', 'x', '4'])
+        self.assertIn("invalid 'l' value at position 3: 'x'",
+                      self.stderr.getvalue())
+
+        self.assertRaises(ValueError, cmd.parser.add_argument, '--foo',
+                          action=climax.Array, typecode='u')
+
+    @mock.patch.dict('sys.modules', {'numpy': mock.MagicMock()})
+    def test_array_numpy(self):
+        numpy = sys.modules['numpy']
+
+        @climax.command()
+        @climax.argument('values', action=climax.Array, typecode='i')
+        @climax.argument('--raw', action=climax.Array, numpy=False)
+        def cmd(values, raw):
+            return values, raw
+
+        values, raw = cmd(['1', '2', '--raw', '3'])
+        numpy.frombuffer.assert_called_once_with(array.array('i', [1, 2]),
+                                                 dtype='i')
+        self.assertEqual(values, numpy.frombuffer.return_value)
+        self.assertEqual(raw, array.array('d', [3]))
+
+    def test_response_files(self):
+        @climax.group(response_files=True)
+        @climax.argument('--foo')
+        def grp(foo):
+            return {'foo': foo}
+
+        @grp.command()
+        @climax.argument('names', nargs='*')
+        def cmd(names, foo):
+            return foo, names
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        inner = os.path.join(tmpdir, 'inner')
+        outer = os.path.join(tmpdir, 'outer')
+        with open(inner, 'w') as f:
+            f.write('"c\nd" e\n')
+        with open(outer, 'w') as f:
+            f.write('# options\n--foo "x y"\ncmd a b \'@' + inner + '\'\n')
+
+        self.assertEqual(grp(['@' + outer, 'f']),
+                         ('x y', ['a', 'b', 'c\nd', 'e', 'f']))
+
+        with mock.patch('sys.stdin', StringIO('cmd g h')):
+            self.assertEqual(grp(['--foo', 'z', '@-']), ('z', ['g', 'h']))
+
+        with mock.patch('sys.stdin', StringIO(
+                'cmd /data/issue#12/a.txt /data/b.txt\n'
+                '# comment\n"#c" d#\'e f\'\n')):
+            self.assertEqual(grp(['@-']), (None, [
+                '/data/issue#12/a.txt', '/data/b.txt', '#c', 'd#e f']))
+
+        self.assertRaises(SystemExit, grp, ['@' + tmpdir + '/bad'])
+        self.assertIn('No such file or directory', self.stderr.getvalue())
+
+        with open(inner, 'w') as f:
+            f.write('"a b\n' + 'c d\n' * 10000)
+        self.assertRaises(SystemExit, grp, ['cmd', '@' + inner])
+        self.assertIn('No closing quotation', self.stderr.getvalue())
+
+        with open(inner, 'w') as f:
+            f.write("  # it's a comment\na\n'@" + outer + "'")
+        self._reset_stderr()
+        self.assertRaises(SystemExit, grp, ['cmd', '@' + outer])
+        self.assertIn('response file ' + outer + ' includes itself',
+                      self.stderr.getvalue())
+
+    def test_command_response_files(self):
+        @climax.command(response_files=True)
+        @climax.argument('names', nargs='*')
+        def cmd(names):
+            return names
+
+        @climax.command()
+        @climax.argument('names', nargs='*')
+        def cmd2(names):
+            return names
+
+        with mock.patch('sys.stdin', StringIO('a b')):
+            with mock.patch('sys.argv', ['cmd', '@-', 'c']):
+                self.assertEqual(cmd(), ['a', 'b', 'c'])
+        self.assertEqual(cmd2(['@-']), ['@-'])
+
+    def _metrics_cli(self):
+        @climax.group()
+        def main():
+            pass
+
+        @main.group()
+        def remote():
+            pass
+
+        @remote.command('add')
+        @climax.argument('name')
+        def remote_add(name):
+            return name
+
+        @main.command()
+        @climax.argument('--status', type=int)
+        def fail(status):
+            if status is None:
+                raise ValueError()
+            sys.exit(status)
+
+        return main
+
+    def test_metrics(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(climax.disable_metrics)
+        path = os.path.join(tmpdir, 'metrics.prom')
+        metrics = climax.enable_metrics(path)
+        main = self._metrics_cli()
+
+        self.assertEqual(main(['remote', 'add', 'foo']), 'foo')
+        self.assertEqual(main(['remote', 'add', 'bar']), 'bar')
+        self.assertRaises(SystemExit, main, ['fail', '--status', '3'])
+        self.assertRaises(SystemExit, main, ['remote'])
+        metrics.write()
+        self.assertRaises(ValueError, main, ['fail'])
+        main(['remote', 'add', 'baz'])
+        metrics.write()
+        metrics.write()
+
+        with open(path) as f:
+            data = f.read()
+        self.assertIn('# TYPE climax_duration_seconds histogram\n', data)
+        self.assertIn(
+            'climax_invocations_total{command="main.remote.add"} 3\n', data)
+        self.assertIn('climax_exits_total{command="main.fail",status="3"} 1\n',
+                      data)
+        self.assertIn('climax_exits_total{command="main.fail",status="1"} 1\n',
+                      data)
+        self.assertIn(
+            'climax_exits_total{command="main.remote",status="2"} 1\n', data)
+        for phase in ['parse', 'group', 'command']:
+            self.assertIn(
+                'climax_duration_seconds_bucket{command="main.remote.add",'
+                'le="+Inf",phase="' + phase + '"} 3\n', data)
+            self.assertIn(
+                'climax_duration_seconds_count{command="main.remote.add",'
+                'phase="' + phase + '"} 3\n', data)
+        self.assertNotIn('command="main.remote",phase="command"', data)
+        self.assertIn(
+            'climax_duration_seconds_count{command="main.fail",'
+            'phase="command"} 2\n', data)
+
+    def test_metrics_json(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(climax.disable_metrics)
+        path = os.path.join(tmpdir, 'metrics.json')
+        climax.enable_metrics(path, interval=0.01)
+
+        @climax.command()
+        def cmd():
+            pass
+
+        cmd([])
+        for i in range(100):
+            if os.path.exists(path):
+                break
+            time.sleep(0.01)
+        climax._metrics.record('cmd', 0, {})
+        climax._metrics.write()
+
+        with open(path) as f:
+            data = json.load(f)
+        self.assertIn({'name': 'climax_invocations_total',
+                       'labels': {'command': 'cmd'}, 'value': 2}, data)
+        self.assertIn({'name': 'climax_duration_seconds_count',
+                       'labels': {'command': 'cmd', 'phase': 'command'},
+                       'value': 1}, data)
+
+    def test_metrics_reenable(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(climax.disable_metrics)
+        path1 = os.path.join(tmpdir, 'metrics1.json')
+        path2 = os.path.join(tmpdir, 'metrics2.json')
+        threads = threading.active_count()
+        metrics = climax.enable_metrics(path1, interval=60)
+        self.assertEqual(threading.active_count(), threads + 1)
+        self.assertIs(climax.enable_metrics(path2, interval=60), metrics)
+        for i in range(100):
+            if threading.active_count() == threads + 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(threading.active_count(), threads + 1)
+
+        @climax.command()
+        def cmd():
+            time.sleep(0.01)
+            sys.exit(3)
+
+        self.assertRaises(SystemExit, cmd, [])
+        climax.disable_metrics()
+        self.assertIsNone(climax._metrics)
+        for i in range(100):
+            if threading.active_count() == threads:
+                break
+            time.sleep(0.01)
+        self.assertEqual(threading.active_count(), threads)
+        self.assertFalse(os.path.exists(path1))
+        with open(path2) as f:
+            data = json.load(f)
+        self.assertIn({'name': 'climax_exits_total',
+                       'labels': {'command': 'cmd', 'status': '3'},
+                       'value': 1}, data)
+        durations = [sample['value'] for sample in data
+                     if sample['name'] == 'climax_duration_seconds_sum' and
+                     sample['labels']['phase'] == 'command']
+        self.assertEqual(len(durations), 1)
+        self.assertGreaterEqual(durations[0], 0.01)
+
+    def test_concurrent_invocations(self):
+        @climax.group()
+        @climax.argument('--offset', type=int, default=0)
+        def grp(offset):
+            return {'offset': offset}
+
+        @grp.group()
+        def sub(offset):
+            return {'offset': offset * 2}
+
+        @sub.command()
+        @climax.argument('values', action=climax.Array, typecode='l')
+        def add(values, offset):
+            return sum(values) + offset
+
+        def register():
+            for i in range(50):
+                @grp.command('late{}'.format(i))
+                @climax.argument('name')
+                def late(name, offset):
+                    return name
+
+        def invoke(i):
+            if i % 2:
+                return grp(['--offset', str(i), 'sub', 'add', '1', str(i)])
+            name = 'late{}'.format(i % 50)
+            if name not in grp._subparsers.choices:
+                return None
+            return grp([name, str(i)])
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            registration = executor.submit(register)
+            results = list(executor.map(invoke, range(2000)))
+            registration.result()
+
+        for i, result in enumerate(results):
+            if i % 2:
+                self.assertEqual(result, 1 + 3 * i)
+            else:
+                self.assertIn(result, [None, str(i)])
+        self.assertEqual(len(grp._subparsers.choices), 51)
+        for i in range(50):
+            self.assertEqual(grp(['late{}'.format(i), 'foo']), 'foo')
+        self.assertEqual(self.stderr.getvalue(), '')
+
+    @unittest.skipIf(not hasattr(signal, 'SIGALRM'), 'requires signals')
+    def test_timeout(self):
+        @climax.command(timeout=0.05)
+        def cmd():
+            time.sleep(5)
+
+        handler = signal.getsignal(signal.SIGALRM)
+        with self.assertRaises(SystemExit) as cm:
+            cmd([])
+        self.assertEqual(cm.exception.code, 124)
+        self.assertIn('time limit exceeded', self.stderr.getvalue())
+        self.assertEqual(signal.getsignal(signal.SIGALRM), handler)
+        self.assertEqual(signal.getitimer(signal.ITIMER_REAL), (0.0, 0.0))
+
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            self.assertEqual(executor.submit(
+                climax.command(timeout=0.01)(lambda: 'foo'), []).result(),
+                'foo')
+
+    @unittest.skipIf(not hasattr(signal, 'SIGALRM'), 'requires signals')
+    def test_timeout_restores_timer(self):
+        @climax.command(timeout=10)
+        def cmd():
+            time.sleep(0.1)
+            return 'foo'
+
+        alarms = []
+        handler = signal.signal(signal.SIGALRM,
+                                lambda signum, frame: alarms.append(signum))
+        self.addCleanup(signal.signal, signal.SIGALRM, handler)
+        signal.setitimer(signal.ITIMER_REAL, 0.3)
+        self.addCleanup(signal.setitimer, signal.ITIMER_REAL, 0)
+
+        self.assertEqual(cmd([]), 'foo')
+        self.assertLess(signal.getitimer(signal.ITIMER_REAL)[0], 0.21)
+        self.assertEqual(alarms, [])
+        time.sleep(0.5)
+        self.assertEqual(alarms, [signal.SIGALRM])
+
+    @unittest.skipIf(not hasattr(signal, 'SIGALRM'), 'requires signals')
+    def test_timeout_async(self):
+        @climax.group(timeout=10)
+        def grp():
+            pass
+
+        @grp.command(timeout=0.05)
+        def cmd():
+            async def task():
+                try:
+                    await asyncio.sleep(5)
+                finally:
+                    cancelled.append(True)
+
+            asyncio.run(task())
+
+        cancelled = []
+        with self.assertRaises(SystemExit) as cm:
+            grp(['cmd'])
+        self.assertEqual(cm.exception.code, 124)
+        self.assertEqual(cancelled, [True])
+
+    @unittest.skipIf(resource is None, 'requires resource module')
+    def test_limit_options(self):
+        @climax.group(limit_options=True, max_rss='2G', timeout=None)
+        def grp():
+            pass
+
+        @grp.command(cpu_seconds=1000)
+        def cmd():
+            return (resource.getrlimit(resource.RLIMIT_AS)[0],
+                    resource.getrlimit(resource.RLIMIT_CPU)[0],
+                    signal.getitimer(signal.ITIMER_REAL)[0])
+
+        limits = (resource.getrlimit(resource.RLIMIT_AS),
+                  resource.getrlimit(resource.RLIMIT_CPU))
+        as_limit, cpu_limit, timer = grp(['cmd'])
+        self.assertEqual(as_limit, 2 * 1024 ** 3)
+        self.assertGreaterEqual(cpu_limit, 1000)
+        self.assertEqual(timer, 0)
+
+        as_limit, cpu_limit, timer = grp(['--max-rss', '1.5g', '--timeout',
+                                          '100', 'cmd'])
+        self.assertEqual(as_limit, 1536 * 1024 ** 2)
+        self.assertGreater(timer, 99)
+        self.assertEqual(limits, (resource.getrlimit(resource.RLIMIT_AS),
+                                  resource.getrlimit(resource.RLIMIT_CPU)))
+
+        # limits set by the operator are never raised
+        for name, value in [(resource.RLIMIT_AS, 8 * 1024 ** 3),
+                            (resource.RLIMIT_CPU, 100000)]:
+            soft, hard = resource.getrlimit(name)
+            if hard == resource.RLIM_INFINITY or hard > value:
+                self.addCleanup(resource.setrlimit, name, (soft, hard))
+                resource.setrlimit(name, (value, hard))
+        as_limit, cpu_limit, timer = grp(['--max-rss', '16G',
+                                          '--cpu-seconds', '1000000', 'cmd'])
+        self.assertLessEqual(as_limit, 8 * 1024 ** 3)
+        self.assertLessEqual(cpu_limit, 100000)
+        as_limit, cpu_limit, timer = grp(['--max-rss', '1G', 'cmd'])
+        self.assertEqual(as_limit, 1024 ** 3)
+
+        self.assertRaises(SystemExit, grp, ['--max-rss', '1X', 'cmd'])
+        self.assertIn("invalid size: '1X'", self.stderr.getvalue())
+        self.assertRaises(argparse.ArgumentTypeError, climax.command(
+            max_rss='foo'), lambda: None)
+
+    def test_cached(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        calls = []
+
+        @climax.group()
+        def grp():
+            return {'ctx': 'foo'}
+
+        @grp.command()
+        @climax.cached(cache_dir=tmpdir, key=['name', 'ctx'], version='1')
+        @climax.argument('name')
+        @climax.argument('--verbose', action='store_true')
+        def cmd(name, verbose, ctx):
+            calls.append(name)
+            print('hello', name)
+            return {'name': name}
+
+        self.assertEqual(grp(['cmd', 'a']), {'name': 'a'})
+        self.assertEqual(grp(['cmd', 'a', '--verbose']), {'name': 'a'})
+        self.assertEqual(grp(['cmd', 'b']), {'name': 'b'})
+        self.assertEqual(grp(['cmd', 'a', '--no-cache']), {'name': 'a'})
+        self.assertEqual(calls, ['a', 'b', 'a'])
+        self.assertEqual(self.stdout.getvalue(), 'hello a\n' * 2 +
+                         'hello b\nhello a\n')
+
+        @climax.command()
+        @climax.cached(cache_dir=tmpdir, key=['name', 'ctx'], version='2')
+        @climax.argument('name')
+        def cmd2(name):
+            calls.append(name)
+            return lambda: name
+
+        cmd2(['a'])
+        cmd2(['a'])
+        self.assertEqual(calls, ['a', 'b', 'a', 'a', 'a'])
+
+    def test_cached_keys(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        calls = []
+
+        @climax.group()
+        def grp():
+            return {'ctx': object()}
+
+        @grp.command()
+        @climax.cached(cache_dir=tmpdir, key=['values'])
+        @climax.argument('values', action=climax.Array, numpy=False)
+        def cmd(values, ctx):
+            calls.append(len(values))
+            return sum(values)
+
+        @grp.command()
+        @climax.cached(cache_dir=tmpdir)
+        def cmd2(ctx):
+            calls.append('cmd2')
+
+        values = [str(i) for i in range(2000)]
+        self.assertEqual(grp(['cmd'] + values), sum(range(2000)))
+        self.assertEqual(grp(['cmd'] + values[:-1] + ['0']),
+                         sum(range(1999)))
+        self.assertEqual(grp(['cmd'] + values), sum(range(2000)))
+        self.assertEqual(calls, [2000, 2000])
+
+        with self.assertWarns(UserWarning):
+            grp(['cmd2'])
+        with self.assertWarns(UserWarning):
+            grp(['cmd2'])
+        self.assertEqual(calls, [2000, 2000, 'cmd2', 'cmd2'])
+        self.assertEqual(len(os.listdir(tmpdir)), 1)
+
+    def test_cached_write_errors(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'file')
+        with open(path, 'w'):
+            pass
+
+        @climax.command()
+        @climax.cached(cache_dir=path)
+        def cmd():
+            print('foo')
+            return 'bar'
+
+        self.assertEqual(cmd([]), 'bar')
+        self.assertEqual(cmd([]), 'bar')
+        self.assertEqual(self.stdout.getvalue(), 'foo\nfoo\n')
+
+    def test_cached_stale(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        module = types.ModuleType('climax_test_stale')
+        self.addCleanup(sys.modules.pop, 'climax_test_stale', None)
+        sys.modules['climax_test_stale'] = module
+        exec('class R(object):\n    pass\n', module.__dict__)
+        calls = []
+
+        @climax.command()
+        @climax.cached(cache_dir=tmpdir)
+        def cmd():
+            calls.append(None)
+            return getattr(module, 'R', None)
+
+        self.assertIs(cmd([]), module.R)
+        self.assertIs(cmd([]), module.R)
+        self.assertEqual(len(calls), 1)
+
+        # the class of the cached result was renamed
+        module.S = module.R
+        del module.R
+        self.assertIsNone(cmd([]))
+        self.assertEqual(len(calls), 2)
+
+    @unittest.skipIf(not hasattr(os, 'getuid'), 'requires Unix permissions')
+    def test_cached_untrusted_dir(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        calls = []
+
+        @climax.command()
+        @climax.cached(cache_dir=tmpdir)
+        def cmd():
+            calls.append(None)
+            return 'bar'
+
+        self.assertEqual(cmd([]), 'bar')
+        self.assertEqual(cmd([]), 'bar')
+        self.assertEqual(len(calls), 1)
+        os.chmod(os.path.join(tmpdir, os.listdir(tmpdir)[0]), 0o777)
+        self.assertEqual(cmd([]), 'bar')
+        self.assertEqual(len(calls), 2)
+
+    def test_cached_concurrent(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        barrier = threading.Barrier(8)
+
+        @climax.command()
+        @climax.cached(cache_dir=tmpdir)
+        @climax.argument('name')
+        def cmd(name):
+            barrier.wait()
+            for i in range(20):
+                print(name, i)
+            return name
+
+        names = [str(i) for i in range(8)]
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda name: cmd([name]), names))
+        self._reset_stdout()
+
+        for name in names:
+            self.assertEqual(cmd([name]), name)
+            self.assertEqual(self.stdout.getvalue(), ''.join(
+                '{} {}\n'.format(name, i) for i in range(20)))
+            self._reset_stdout()
+
+    def test_cached_eviction(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        calls = []
+
+        @climax.command()
+        @climax.cached(cache_dir=tmpdir, max_size=0)
+        def cmd2():
+            calls.append('cmd2')
+
+        with mock.patch.dict('os.environ', {'CLIMAX_CACHE_DIR': tmpdir}):
+            @climax.command()
+            @climax.cached(ttl=0.05)
+            @climax.argument('name')
+            def cmd(name):
+                calls.append(name)
+                return name
+
+        cmd(['a'])
+        cmd(['b'])
+        cmd(['a'])
+        time.sleep(0.1)
+        cmd(['c'])
+        cmd(['b'])
+        cmd2([])
+        cmd2([])
+        self.assertEqual(calls, ['a', 'b', 'c', 'b', 'cmd2', 'cmd2'])
+        entries = os.listdir(os.path.join(
+            tmpdir, 'test_climax.TestClips.test_cached_eviction._locals_.cmd'))
+        self.assertEqual(len(entries), 2)
+
+    @mock.patch('climax.getpass.getpass', return_value='secret')
+    def test_password_sources(self, getpass):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'password')
+        with open(path, 'w') as f:
+            f.write('from-file\nfoo\n')
+        rfd, wfd = os.pipe()
+        self.addCleanup(os.close, rfd)
+        os.write(wfd, b'from-fd\nfrom-fd2')
+        os.close(wfd)
+
+        @climax.command()
+        @climax.argument('--password', action=climax.PasswordPrompt,
+                         env='CLIMAX_TEST_PASSWORD', file=path)
+        @climax.argument('--password2', action=climax.PasswordPrompt,
+                         env='CLIMAX_TEST_PASSWORD', fd=rfd,
+                         sources=('env', 'fd', 'prompt'))
+        def pw(password, password2):
+            return password, password2
+
+        self.assertEqual(pw(['--password']), ('from-file', None))
+        with mock.patch.dict('os.environ', {'CLIMAX_TEST_PASSWORD': 'env'}):
+            self.assertEqual(pw(['--password', '--password2']),
+                             ('env', 'env'))
+        self.assertEqual(pw(['--password2']), (None, 'from-fd'))
+        self.assertEqual(pw(['--password2']), (None, 'from-fd2'))
+        getpass.assert_not_called()
+        self.assertEqual(pw(['--password2']), (None, 'secret'))
+        self.assertEqual(pw(['--password2']), (None, 'secret'))
+
+        os.remove(path)
+        self.assertRaises(SystemExit, pw, ['--password'])
+        self.assertIn('No such file or directory', self.stderr.getvalue())
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'requires fork')
+    def test_password_agent(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'agent.sock')
+
+        @climax.command(prog='pw')
+        @climax.argument('--password', action=climax.PasswordPrompt,
+                         agent=path, agent_ttl=0.5)
+        def pw(password):
+            return password
+
+        with mock.patch('climax.getpass.getpass', return_value='secret'):
+            self.assertEqual(pw(['--password']), 'secret')
+        with mock.patch('climax.getpass.getpass', return_value='other') as gp:
+            self.assertEqual(pw(['--password']), 'secret')
+            gp.assert_not_called()
+        self.assertEqual(climax._agent_request(path, {'key': 'foo'}), {})
+
+        for i in range(100):
+            if not os.path.exists(path):
+                break
+            time.sleep(0.05)
+        self.assertFalse(os.path.exists(path))
+        with mock.patch('climax.getpass.getpass', return_value='other'):
+            self.assertEqual(pw(['--password']), 'other')
+        with mock.patch('climax.getpass.getpass') as gp:
+            self.assertEqual(pw(['--password']), 'other')
+            gp.assert_not_called()
+
+        # the key includes the other arguments
+        @climax.command(prog='pw')
+        @climax.argument('--user')
+        @climax.argument('--password', action=climax.PasswordPrompt,
+                         agent=path, agent_ttl=0.5)
+        def login(user, password):
+            return password
+
+        with mock.patch('climax.getpass.getpass', return_value='a-secret'):
+            self.assertEqual(login(['--user', 'a', '--password']),
+                             'a-secret')
+        with mock.patch('climax.getpass.getpass', return_value='b-secret'):
+            self.assertEqual(login(['--password', '--user', 'b']),
+                             'b-secret')
+        with mock.patch('climax.getpass.getpass') as gp:
+            self.assertEqual(login(['--password', '--user', 'a']),
+                             'a-secret')
+            self.assertEqual(login(['--user', 'b', '--password']),
+                             'b-secret')
+            gp.assert_not_called()
+        with mock.patch('climax.sys.argv', ['/other/pw']):
+            with mock.patch('climax.getpass.getpass', return_value='c'):
+                self.assertEqual(login(['--user', 'a', '--password']), 'c')
+
+        # or only the ones selected by the application
+        @climax.command(prog='pw')
+        @climax.argument('--user')
+        @climax.argument('--verbose', action='store_true')
+        @climax.argument('--password', action=climax.PasswordPrompt,
+                         agent=path, agent_ttl=0.5,
+                         agent_key=lambda args: args.user)
+        def login2(user, verbose, password):
+            return password
+
+        with mock.patch('climax.getpass.getpass', return_value='d-secret'):
+            self.assertEqual(login2(['--user', 'd', '--password']),
+                             'd-secret')
+        with mock.patch('climax.getpass.getpass') as gp:
+            self.assertEqual(login2(['--user', 'd', '--verbose',
+                                     '--password']), 'd-secret')
+            gp.assert_not_called()
+
+        # parsers that are not used by climax commands do not use the agent
+        parser = argparse.ArgumentParser(prog='pw')
+        parser.add_argument('--password', action=climax.PasswordPrompt,
+                            agent=path)
+        with mock.patch('climax.getpass.getpass', return_value='e') as gp:
+            self.assertEqual(parser.parse_args(['--password']).password, 'e')
+            gp.assert_called_once_with()
+
+        with mock.patch.dict('os.environ', {'XDG_RUNTIME_DIR': tmpdir}):
+            os.chmod(tmpdir, 0o700)
+            self.assertEqual(climax._agent_path(),
+                             os.path.join(tmpdir, 'climax-agent.sock'))
+            os.chmod(tmpdir, 0o755)
+            self.assertIsNone(climax._agent_path())
+
+        @climax.command()
+        @climax.argument('--password', action=climax.PasswordPrompt,
+                         env='CLIMAX_TEST_PASSWORD', agent=True,
+                         sources=('agent', 'env'))
+        def pw2(password):
+            return password
+
+        missing = os.path.join(tmpdir, 'missing')
+        with mock.patch.dict('os.environ', {'XDG_RUNTIME_DIR': missing,
+                                            'CLIMAX_TEST_PASSWORD': 'env'}):
+            self.assertEqual(pw2(['--password']), 'env')
+        self.assertFalse(os.path.exists(missing))
+
+    def _make_plugin_dist(self, path, version, plugins):
+        dist_info = os.path.join(path, 'climax_plugins-{}.dist-info'.format(
+            version))
+        os.mkdir(dist_info)
+        with open(os.path.join(dist_info, 'METADATA'), 'w') as f:
+            f.write('Metadata-Version: 2.1\nName: climax-plugins\n'
+                    'Version: {}\n'.format(version))
+        with open(os.path.join(dist_info, 'entry_points.txt'), 'w') as f:
+            f.write('[climax_test.plugins]\n')
+            for name, value in plugins.items():
+                f.write('{} = {}\n'.format(name, value))
+        return dist_info
+
+    @mock.patch('sys.path', list(sys.path))
+    def test_plugins(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(sys.modules.pop, 'climax_test_plugins', None)
+        sys.path.insert(0, tmpdir)
+        with open(os.path.join(tmpdir, 'climax_test_plugins.py'), 'w') as f:
+            f.write('''import climax
+
+
+@climax.command()
+@climax.argument('name')
+def hello(name, verbose):
+    \"\"\"say hello\"\"\"
+    return 'hello ' + name + (' verbose' if verbose else '')
+
+
+@climax.group()
+@climax.argument('--loud', action='store_true')
+def remote(loud, verbose):
+    \"\"\"manage remotes\"\"\"
+    return {'loud': loud}
+
+
+@remote.command('add')
+@climax.argument('url')
+def remote_add(url, loud):
+    return url.upper() if loud else url
+''')
+        dist_info = self._make_plugin_dist(tmpdir, '1.0', {
+            'hello': 'climax_test_plugins:hello',
+            'remote': 'climax_test_plugins:remote'})
+
+        def make_group():
+            @climax.group(plugins='climax_test.plugins')
+            @climax.argument('--verbose', action='store_true')
+            def grp(verbose):
+                return {'verbose': verbose}
+
+            @grp.command()
+            def builtin(verbose):
+                return 'builtin'
+
+            return grp
+
+        with mock.patch.dict('os.environ', {'CLIMAX_CACHE_DIR': tmpdir}):
+            grp = make_group()
+            self.assertIn('climax_test_plugins', sys.modules)
+            del sys.modules['climax_test_plugins']
+
+            # the second time the plugin index is read from the cache
+            grp = make_group()
+            self.assertNotIn('climax_test_plugins', sys.modules)
+            self.assertRaises(SystemExit, grp, ['--help'])
+            self.assertIn('say hello', self.stdout.getvalue())
+            self.assertIn('manage remotes', self.stdout.getvalue())
+            self.assertNotIn('climax_test_plugins', sys.modules)
+
+            self.assertEqual(grp(['builtin']), 'builtin')
+            self.assertNotIn('climax_test_plugins', sys.modules)
+            self.assertEqual(grp(['--verbose', 'hello', 'foo']),
+                             'hello foo verbose')
+            self.assertIn('climax_test_plugins', sys.modules)
+            self.assertEqual(grp(['remote', 'add', 'foo']), 'foo')
+            self.assertEqual(grp(['remote', '--loud', 'add', 'foo']), 'FOO')
+            self.assertRaises(SystemExit, grp, ['remote'])
+            self.assertIn('too few arguments', self.stderr.getvalue())
+
+            # a new version of the plugins invalidates the cached index
+            shutil.rmtree(dist_info)
+            self._make_plugin_dist(tmpdir, '2.0', {
+                'hi': 'climax_test_plugins:hello'})
+            grp = make_group()
+            self.assertEqual(grp(['hi', 'bar']), 'hello bar')
+            self.assertRaises(SystemExit, grp, ['hello', 'bar'])
+
+            @climax.group()
+            def grp2():
+                pass
+
+            @grp2.group(plugins='climax_test.plugins')
+            def sub():
+                return {'verbose': True}
+
+            self.assertEqual(grp2(['sub', 'hi', 'baz']), 'hello baz verbose')
+
+    @mock.patch('sys.path', list(sys.path))
+    def test_plugins_broken(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(sys.modules.pop, 'climax_test_plugins', None)
+        sys.path.insert(0, tmpdir)
+        with open(os.path.join(tmpdir, 'climax_test_plugins.py'), 'w') as f:
+            f.write('''import climax
+
+
+@climax.command()
+def hello():
+    return 'hello'
+''')
+        self._make_plugin_dist(tmpdir, '1.0', {
+            'hello': 'climax_test_plugins:hello',
+            'broken': 'climax_test_plugins_missing:broken'})
+
+        def make_group():
+            @climax.group(plugins='climax_test.plugins')
+            def grp():
+                pass
+
+            @grp.command()
+            def builtin():
+                return 'builtin'
+
+            return grp
+
+        with mock.patch.dict('os.environ', {'CLIMAX_CACHE_DIR': tmpdir}):
+            with self.assertWarns(UserWarning) as cm:
+                grp = make_group()
+            self.assertIn('plugin broken could not be loaded',
+                          str(cm.warning))
+            self.assertEqual(grp(['builtin']), 'builtin')
+            self.assertEqual(grp(['hello']), 'hello')
+            self.assertRaises(SystemExit, grp, ['broken'])
+            self.assertIn("invalid choice: 'broken'", self.stderr.getvalue())
+
+            # the index is not cached while a plugin is failing
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, 'plugins')))
+
+            # a plugin that breaks after it was indexed reports the error
+            # when it is invoked
+            with open(os.path.join(tmpdir, 'climax_test_plugins.py'),
+                      'w') as f:
+                f.write('import climax_test_plugins_missing\n')
+            del sys.modules['climax_test_plugins']
+            with mock.patch('climax._plugin_index', return_value=[
+                    {'name': 'hello', 'value': 'climax_test_plugins:hello',
+                     'help': 'say hello'}]):
+                grp = make_group()
+            self.assertEqual(grp(['builtin']), 'builtin')
+            self.assertRaises(SystemExit, grp, ['hello'])
+            self.assertIn('plugin hello could not be loaded',
+                          self.stderr.getvalue())
+
 
 if __name__ == '__main__':
     unittest.main()